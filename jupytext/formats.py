@@ -5,9 +5,11 @@ new formats here!
 
 import os
 import re
+import sys
 import warnings
+from functools import lru_cache
 import nbformat
-from .header import header_to_metadata_and_cell, insert_or_test_version_number
+from .header import header_to_metadata_and_cell, insert_or_test_version_number, markdown_header_lines
 from .cell_reader import MarkdownCellReader, RMarkdownCellReader, \
     LightScriptCellReader, RScriptCellReader, DoublePercentScriptCellReader, HydrogenCellReader, \
     SphinxGalleryScriptCellReader
@@ -16,7 +18,7 @@ from .cell_to_text import MarkdownCellExporter, RMarkdownCellExporter, \
     HydrogenCellExporter, SphinxGalleryCellExporter
 from .metadata_filter import metadata_filter_as_string
 from .stringparser import StringParser
-from .languages import _SCRIPT_EXTENSIONS, _COMMENT_CHARS, same_language
+from .languages import _SCRIPT_EXTENSIONS, _COMMENT_CHARS, _COMMENT_FOR_EXT, same_language
 from .pandoc import pandoc_version, is_pandoc_available
 from .magics import is_magic
 from .myst import (
@@ -35,6 +37,9 @@ class JupytextFormatError(ValueError):
 class NotebookFormatDescription:
     """Description of a notebook format"""
 
+    __slots__ = ('format_name', 'extension', 'header_prefix', 'cell_reader_class', 'cell_exporter_class',
+                 'current_version_number', 'min_readable_version_number')
+
     def __init__(self,
                  format_name,
                  extension,
@@ -43,8 +48,8 @@ class NotebookFormatDescription:
                  cell_exporter_class,
                  current_version_number,
                  min_readable_version_number=None):
-        self.format_name = format_name
-        self.extension = extension
+        self.format_name = sys.intern(format_name)
+        self.extension = sys.intern(extension)
         self.header_prefix = header_prefix
         self.cell_reader_class = cell_reader_class
         self.cell_exporter_class = cell_exporter_class
@@ -87,12 +92,15 @@ JUPYTEXT_FORMATS = \
             # Version 1.2 on 2019-09-21 - jupytext v1.3.0 : Raw regions are now encoded with HTML comments (#321)
             # and by default, cell metadata use the key=value representation in raw and markdown cells (#347)
             current_version_number='1.2',
-            min_readable_version_number='1.0')] + \
-    [
+            min_readable_version_number='1.0')]
+
+# The script formats, for each script extension (light is the default one)
+for _ext, _comment in _COMMENT_FOR_EXT.items():
+    JUPYTEXT_FORMATS.extend([
         NotebookFormatDescription(
             format_name='light',
-            extension=ext,
-            header_prefix=_SCRIPT_EXTENSIONS[ext]['comment'],
+            extension=_ext,
+            header_prefix=_comment,
             cell_reader_class=LightScriptCellReader,
             cell_exporter_class=LightScriptCellExporter,
             # Version 1.5 on 2019-10-19 - jupytext v1.3.0 - Cell metadata represented as key=value by default
@@ -105,21 +113,21 @@ JUPYTEXT_FORMATS = \
             # with one blank line #38
             # Version 1.0 on 2018-08-22 - jupytext v0.5.2 : Initial version
             current_version_number='1.5',
-            min_readable_version_number='1.1') for ext in _SCRIPT_EXTENSIONS] + \
-    [
+            min_readable_version_number='1.1'),
+
         NotebookFormatDescription(
             format_name='nomarker',
-            extension=ext,
-            header_prefix=_SCRIPT_EXTENSIONS[ext]['comment'],
+            extension=_ext,
+            header_prefix=_comment,
             cell_reader_class=LightScriptCellReader,
             cell_exporter_class=BareScriptCellExporter,
             current_version_number='1.0',
-            min_readable_version_number='1.0') for ext in _SCRIPT_EXTENSIONS] + \
-    [
+            min_readable_version_number='1.0'),
+
         NotebookFormatDescription(
             format_name='percent',
-            extension=ext,
-            header_prefix=_SCRIPT_EXTENSIONS[ext]['comment'],
+            extension=_ext,
+            header_prefix=_comment,
             cell_reader_class=DoublePercentScriptCellReader,
             cell_exporter_class=DoublePercentCellExporter,
             # Version 1.3 on 2019-09-21 - jupytext v1.3.0: Markdown cells can be quoted using triple quotes #305
@@ -129,36 +137,38 @@ JUPYTEXT_FORMATS = \
             # [raw] for markdown and raw cells.
             # Version 1.0 on 2018-09-22 - jupytext v0.7.0rc0 : Initial version
             current_version_number='1.3',
-            min_readable_version_number='1.1') for ext in _SCRIPT_EXTENSIONS] + \
-    [
+            min_readable_version_number='1.1'),
+
         NotebookFormatDescription(
             format_name='hydrogen',
-            extension=ext,
-            header_prefix=_SCRIPT_EXTENSIONS[ext]['comment'],
+            extension=_ext,
+            header_prefix=_comment,
             cell_reader_class=HydrogenCellReader,
             cell_exporter_class=HydrogenCellExporter,
             # Version 1.2 on 2018-12-14 - jupytext v0.9.0: same as percent - only magics are not commented by default
             current_version_number='1.3',
-            min_readable_version_number='1.1') for ext in _SCRIPT_EXTENSIONS] + \
-    [
-        NotebookFormatDescription(
-            format_name='spin',
-            extension=ext,
-            header_prefix="#'",
-            cell_reader_class=RScriptCellReader,
-            cell_exporter_class=RScriptCellExporter,
-            # Version 1.0 on 2018-08-22 - jupytext v0.5.2 : Initial version
-            current_version_number='1.0') for ext in ['.r', '.R']] + \
-    [
-        NotebookFormatDescription(
-            format_name='sphinx',
-            extension='.py',
-            header_prefix='#',
-            cell_reader_class=SphinxGalleryScriptCellReader,
-            cell_exporter_class=SphinxGalleryCellExporter,
-            # Version 1.0 on 2018-09-22 - jupytext v0.7.0rc0 : Initial version
-            current_version_number='1.1')
-    ]
+            min_readable_version_number='1.1')])
+del _ext, _comment
+
+JUPYTEXT_FORMATS.extend([
+    NotebookFormatDescription(
+        format_name='spin',
+        extension=ext,
+        header_prefix="#'",
+        cell_reader_class=RScriptCellReader,
+        cell_exporter_class=RScriptCellExporter,
+        # Version 1.0 on 2018-08-22 - jupytext v0.5.2 : Initial version
+        current_version_number='1.0') for ext in ['.r', '.R']])
+
+JUPYTEXT_FORMATS.append(
+    NotebookFormatDescription(
+        format_name='sphinx',
+        extension='.py',
+        header_prefix='#',
+        cell_reader_class=SphinxGalleryScriptCellReader,
+        cell_exporter_class=SphinxGalleryCellExporter,
+        # Version 1.0 on 2018-09-22 - jupytext v0.7.0rc0 : Initial version
+        current_version_number='1.1'))
 
 if is_pandoc_available():
     JUPYTEXT_FORMATS.append(NotebookFormatDescription(
@@ -180,20 +190,34 @@ if is_myst_available():
 
 NOTEBOOK_EXTENSIONS = list(dict.fromkeys(['.ipynb'] + [fmt.extension for fmt in JUPYTEXT_FORMATS]))
 EXTENSION_PREFIXES = ['.lgt', '.spx', '.pct', '.hyd', '.nb']
+_LEGITIMATE_EXTENSIONS = frozenset(NOTEBOOK_EXTENSIONS + ['.auto'])
+
+# Index of the formats by extension, and by extension and format name (the first format is the default one).
+# The index is built at import, so formats added to JUPYTEXT_FORMATS after that are not seen
+_FORMATS_BY_EXT = {ext: [fmt for fmt in JUPYTEXT_FORMATS if fmt.extension == ext] for ext in NOTEBOOK_EXTENSIONS}
+_FORMATS_BY_EXT_NAME = {(fmt.extension, fmt.format_name): fmt for fmt in reversed(JUPYTEXT_FORMATS)}
+_FORMATS_BY_EXT_NAME.update({(ext, None): formats[0] for ext, formats in _FORMATS_BY_EXT.items() if formats})
+
+# Regular expressions used by guess_format, compiled once for each comment marker
+_TWENTY_HASH_RE = re.compile(r'^#( |)#{19,}\s*$')
+# A single scan identifies the percent (or nbconvert) cell markers, and the vim or vscode folding markers.
+# Escaped Jupyter magics (no space between %% and command) are not cell markers
+_CELL_MARKER_RE = {comment: re.compile(
+    r'^{}(?:(?P<percent>(?: %%|%%)(?:$|\s)| <codecell>| In\[[0-9 ]*\]:?)|\s*(?P<vim>{{{{{{)|\s*(?P<vscode>region))'
+    .format(re.escape(comment))) for comment in set(_COMMENT_FOR_EXT.values())}
+_STRING_PARSER_LANGUAGE = {'.r': 'R', '.R': 'R'}
 
 
 def get_format_implementation(ext, format_name=None):
     """Return the implementation for the desired format"""
     # remove pre-extension if any
-    ext = '.' + ext.split('.')[-1]
+    ext = '.' + ext.rpartition('.')[2]
 
-    formats_for_extension = []
-    for fmt in JUPYTEXT_FORMATS:
-        if fmt.extension == ext:
-            if fmt.format_name == format_name or not format_name:
-                return fmt
-            formats_for_extension.append(fmt.format_name)
+    fmt = _FORMATS_BY_EXT_NAME.get((ext, format_name or None))
+    if fmt is not None:
+        return fmt
 
+    formats_for_extension = [fmt.format_name for fmt in _FORMATS_BY_EXT.get(ext, [])]
     if formats_for_extension:
         if ext in ['.md', '.markdown'] and format_name == 'pandoc':
             raise JupytextFormatError('Please install pandoc>=2.7.2')
@@ -208,16 +232,22 @@ def get_format_implementation(ext, format_name=None):
 
 def read_metadata(text, ext):
     """Return the header metadata"""
-    ext = '.' + ext.split('.')[-1]
-    lines = text.splitlines()
+    ext = '.' + ext.rpartition('.')[2]
+    if ext in ['.md', '.markdown', '.Rmd']:
+        return _read_metadata_from_lines(markdown_header_lines(text), ext)
+    return _read_metadata_from_lines(text.splitlines(), ext)
 
+
+def _read_metadata_from_lines(lines, ext):
+    """Return the header metadata, given the lines of the file and its (last) extension"""
     if ext in ['.md', '.markdown', '.Rmd']:
         comment = ''
     else:
-        comment = _SCRIPT_EXTENSIONS.get(ext, {}).get('comment', '#')
+        comment = _COMMENT_FOR_EXT.get(ext, '#')
 
     metadata, _, _, _ = header_to_metadata_and_cell(lines, comment, ext)
-    if ext in ['.r', '.R'] and not metadata:
+    # A spin header starts on the first line (a shebang or an encoding would have been found above)
+    if ext in ['.r', '.R'] and not metadata and lines and lines[0].startswith("#'"):
         metadata, _, _, _ = header_to_metadata_and_cell(lines, "#'", ext)
 
     return metadata
@@ -232,7 +262,12 @@ def read_format_from_metadata(text, ext):
 
 def guess_format(text, ext):
     """Guess the format and format options of the file, given its extension and content"""
-    metadata = read_metadata(text, ext)
+    # The script and markdown formats read all the lines, the other ones only need the header
+    if ext in _SCRIPT_EXTENSIONS or ext in ['.md', '.markdown']:
+        lines = text.splitlines()
+        metadata = _read_metadata_from_lines(lines, ext)
+    else:
+        metadata = read_metadata(text, ext)
 
     if 'text_representation' in metadata.get('jupytext', {}):
         return format_name_for_ext(metadata, ext), {}
@@ -240,19 +275,12 @@ def guess_format(text, ext):
     if is_myst_available() and matches_mystnb(text, ext):
         return MYST_FORMAT_NAME, {}
 
-    lines = text.splitlines()
-
     # Is this a Hydrogen-like script?
     # Or a Sphinx-gallery script?
     if ext in _SCRIPT_EXTENSIONS:
-        comment = _SCRIPT_EXTENSIONS[ext]['comment']
+        comment = _COMMENT_FOR_EXT[ext]
         language = _SCRIPT_EXTENSIONS[ext]['language']
-        twenty_hash_re = re.compile(r'^#( |)#{19,}\s*$')
-        double_percent_re = re.compile(r'^{}( %%|%%)$'.format(comment))
-        double_percent_and_space_re = re.compile(r'^{}( %%|%%)\s'.format(comment))
-        nbconvert_script_re = re.compile(r'^{}( <codecell>| In\[[0-9 ]*\]:?)'.format(comment))
-        vim_folding_markers_re = re.compile(r'^{}\s*'.format(comment) + '{{{')
-        vscode_folding_markers_re = re.compile(r'^{}\s*region'.format(comment))
+        cell_marker_re = _CELL_MARKER_RE[comment]
 
         twenty_hash_count = 0
         double_percent_count = 0
@@ -260,32 +288,37 @@ def guess_format(text, ext):
         rspin_comment_count = 0
         vim_folding_markers_count = 0
         vscode_folding_markers_count = 0
+        count_twenty_hash = ext == '.py'
+        count_rspin_comments = ext in ['.R', '.r']
 
-        parser = StringParser(language='R' if ext in ['.r', '.R'] else 'python')
+        parser = StringParser(language=_STRING_PARSER_LANGUAGE.get(ext, 'python'))
         for line in lines:
             parser.read_line(line)
             if parser.is_quoted():
                 continue
 
-            # Don't count escaped Jupyter magics (no space between %% and command) as cells
-            if double_percent_re.match(line) or double_percent_and_space_re.match(line) or \
-                    nbconvert_script_re.match(line):
-                double_percent_count += 1
+            cell_marker = cell_marker_re.match(line)
+            if cell_marker:
+                if cell_marker.lastgroup == 'percent':
+                    double_percent_count += 1
+                elif cell_marker.lastgroup == 'vim':
+                    vim_folding_markers_count += 1
+                else:
+                    vscode_folding_markers_count += 1
 
             if not line.startswith(comment) and is_magic(line, language):
                 magic_command_count += 1
 
-            if twenty_hash_re.match(line) and ext == '.py':
+            # Sphinx-gallery separators have at least 20 characters
+            if count_twenty_hash and len(line) >= 20 and _TWENTY_HASH_RE.match(line):
                 twenty_hash_count += 1
 
-            if line.startswith("#'") and ext in ['.R', '.r']:
+            if count_rspin_comments and line.startswith("#'"):
                 rspin_comment_count += 1
 
-            if vim_folding_markers_re.match(line):
-                vim_folding_markers_count += 1
-
-            if vscode_folding_markers_re.match(line):
-                vscode_folding_markers_count += 1
+            # Cell markers and magic commands were found: this is a Hydrogen script
+            if double_percent_count and magic_command_count:
+                break
 
         if double_percent_count >= 1:
             if magic_command_count:
@@ -372,18 +405,20 @@ def check_file_version(notebook, source_path, outputs_path):
 
 def format_name_for_ext(metadata, ext, cm_default_formats=None, explicit_default=True):
     """Return the format name for that extension"""
+    jupytext_metadata = metadata.get('jupytext') or {}
+
     # Is the format information available in the text representation?
-    text_repr = metadata.get('jupytext', {}).get('text_representation', {})
-    if text_repr.get('extension', '').endswith(ext) and text_repr.get('format_name'):
+    text_repr = jupytext_metadata.get('text_representation')
+    if text_repr and text_repr.get('extension', '').endswith(ext) and text_repr.get('format_name'):
         return text_repr.get('format_name')
 
     # Format from jupytext.formats
-    formats = metadata.get('jupytext', {}).get('formats', '') or cm_default_formats
-    formats = long_form_multiple_formats(formats)
-    for fmt in formats:
-        if fmt['extension'] == ext:
-            if (not explicit_default) or fmt.get('format_name'):
-                return fmt.get('format_name')
+    formats = jupytext_metadata.get('formats') or cm_default_formats
+    if formats:
+        for fmt in long_form_multiple_formats(formats):
+            if fmt['extension'] == ext:
+                if (not explicit_default) or fmt.get('format_name'):
+                    return fmt.get('format_name')
 
     if (not explicit_default) or ext in ['.md', '.markdown', '.Rmd']:
         return None
@@ -408,31 +443,40 @@ def update_jupytext_formats_metadata(metadata, new_format):
 
     for fmt in formats:
         if identical_format_path(fmt, new_format):
+            if fmt.get('format_name') == new_format.get('format_name'):
+                return
             fmt['format_name'] = new_format.get('format_name')
             break
+    else:
+        return
 
     metadata.setdefault('jupytext', {})['formats'] = short_form_multiple_formats(formats)
 
 
-def rearrange_jupytext_metadata(metadata):
-    """Convert the jupytext_formats metadata entry to jupytext/formats, etc. See #91"""
+_NBRMD_KEYS = {'nbrmd_formats': 'jupytext_formats', 'nbrmd_format_version': 'jupytext_format_version'}
+_LEGACY_KEYS = frozenset(['jupytext_formats', 'jupytext_format_version', 'main_language', 'encoding',
+                          'executable']).union(_NBRMD_KEYS)
 
-    # Backward compatibility with nbrmd
-    for key in ['nbrmd_formats', 'nbrmd_format_version']:
-        if key in metadata:
-            metadata[key.replace('nbrmd', 'jupytext')] = metadata.pop(key)
 
+def rearrange_jupytext_metadata(metadata):
+    """Convert the jupytext_formats metadata entry to jupytext/formats, etc. See #91"""
     jupytext_metadata = metadata.pop('jupytext', {})
 
-    if 'jupytext_formats' in metadata:
-        jupytext_metadata['formats'] = metadata.pop('jupytext_formats')
-    if 'jupytext_format_version' in metadata:
-        jupytext_metadata['text_representation'] = {'format_version': metadata.pop('jupytext_format_version')}
-    if 'main_language' in metadata:
-        jupytext_metadata['main_language'] = metadata.pop('main_language')
-    for entry in ['encoding', 'executable']:
-        if entry in metadata:
-            jupytext_metadata[entry] = metadata.pop(entry)
+    if not _LEGACY_KEYS.isdisjoint(metadata):
+        # Backward compatibility with nbrmd
+        for key in _NBRMD_KEYS:
+            if key in metadata:
+                metadata[_NBRMD_KEYS[key]] = metadata.pop(key)
+
+        if 'jupytext_formats' in metadata:
+            jupytext_metadata['formats'] = metadata.pop('jupytext_formats')
+        if 'jupytext_format_version' in metadata:
+            jupytext_metadata['text_representation'] = {'format_version': metadata.pop('jupytext_format_version')}
+        if 'main_language' in metadata:
+            jupytext_metadata['main_language'] = metadata.pop('main_language')
+        for entry in ['encoding', 'executable']:
+            if entry in metadata:
+                jupytext_metadata[entry] = metadata.pop(entry)
 
     filters = jupytext_metadata.pop('metadata_filter', {})
     if 'notebook' in filters:
@@ -469,6 +513,33 @@ def long_form_one_format(jupytext_format, metadata=None, update=None, auto_ext_r
     if not jupytext_format:
         return {}
 
+    fmt = dict(_parse_one_format(jupytext_format))
+
+    if fmt.get('format_name') == 'bare':
+        warnings.warn(
+            "The `bare` format has been renamed to `nomarker` - (see https://github.com/mwouts/jupytext/issues/397)",
+            DeprecationWarning)
+        fmt['format_name'] = 'nomarker'
+
+    ext = fmt['extension']
+    if ext == '.auto':
+        ext = auto_ext_from_metadata(metadata) if metadata is not None else '.auto'
+        if not ext:
+            if auto_ext_requires_language_info:
+                raise JupytextFormatError("No language information in this notebook. Please replace 'auto' with "
+                                          "an actual script extension.")
+            ext = '.auto'
+
+    fmt['extension'] = ext
+    if update:
+        fmt.update(update)
+    return validate_one_format(fmt)
+
+
+@lru_cache(maxsize=256)
+def _parse_one_format(jupytext_format):
+    """Parse 'sfx.py:percent' into {'suffix':'sfx', 'extension':'.py', 'format_name':'percent'}.
+    The result is cached, and should not be modified"""
     common_name_to_ext = {
         'notebook': 'ipynb',
         'rmarkdown': 'Rmd',
@@ -488,12 +559,7 @@ def long_form_one_format(jupytext_format, metadata=None, update=None, auto_ext_r
 
     if jupytext_format.rfind(':') >= 0:
         ext, fmt['format_name'] = jupytext_format.rsplit(':', 1)
-        if fmt['format_name'] == 'bare':
-            warnings.warn(
-                "The `bare` format has been renamed to `nomarker` - (see https://github.com/mwouts/jupytext/issues/397)",
-                DeprecationWarning)
-            fmt['format_name'] = 'nomarker'
-    elif not jupytext_format or '.' in jupytext_format or ('.' + jupytext_format) in NOTEBOOK_EXTENSIONS + ['.auto']:
+    elif not jupytext_format or '.' in jupytext_format or ('.' + jupytext_format) in _LEGITIMATE_EXTENSIONS:
         ext = jupytext_format
     elif jupytext_format in _VALID_FORMAT_NAMES:
         fmt['format_name'] = jupytext_format
@@ -509,18 +575,8 @@ def long_form_one_format(jupytext_format, metadata=None, update=None, auto_ext_r
     if not ext.startswith('.'):
         ext = '.' + ext
 
-    if ext == '.auto':
-        ext = auto_ext_from_metadata(metadata) if metadata is not None else '.auto'
-        if not ext:
-            if auto_ext_requires_language_info:
-                raise JupytextFormatError("No language information in this notebook. Please replace 'auto' with "
-                                          "an actual script extension.")
-            ext = '.auto'
-
     fmt['extension'] = ext
-    if update:
-        fmt.update(update)
-    return validate_one_format(fmt)
+    return fmt
 
 
 def long_form_multiple_formats(jupytext_formats, metadata=None, auto_ext_requires_language_info=True):
@@ -575,6 +631,8 @@ _VALID_FORMAT_INFO = ['extension', 'format_name', 'suffix', 'prefix']
 _BINARY_FORMAT_OPTIONS = ['comment_magics', 'split_at_heading', 'rst2md', 'cell_metadata_json', 'use_runtools']
 _VALID_FORMAT_OPTIONS = _BINARY_FORMAT_OPTIONS + ['notebook_metadata_filter', 'cell_metadata_filter', 'cell_markers']
 _VALID_FORMAT_NAMES = {fmt.format_name for fmt in JUPYTEXT_FORMATS}
+_VALID_FORMAT_KEYS = frozenset(_VALID_FORMAT_INFO + _VALID_FORMAT_OPTIONS)
+_BINARY_FORMAT_OPTIONS_SET = frozenset(_BINARY_FORMAT_OPTIONS)
 
 
 def validate_one_format(jupytext_format):
@@ -587,18 +645,18 @@ def validate_one_format(jupytext_format):
             jupytext_format.get('format_name'), ', '.join(_VALID_FORMAT_NAMES)))
 
     for key in jupytext_format:
-        if key not in _VALID_FORMAT_INFO + _VALID_FORMAT_OPTIONS:
+        if key not in _VALID_FORMAT_KEYS:
             raise JupytextFormatError("Unknown format option '{}' - should be one of '{}'".format(
                 key, "', '".join(_VALID_FORMAT_OPTIONS)))
         value = jupytext_format[key]
-        if key in _BINARY_FORMAT_OPTIONS:
+        if key in _BINARY_FORMAT_OPTIONS_SET:
             if not isinstance(value, bool):
                 raise JupytextFormatError("Format option '{}' should be a bool, not '{}'".format(key, str(value)))
 
     if 'extension' not in jupytext_format:
         raise JupytextFormatError('Missing format extension')
     ext = jupytext_format['extension']
-    if ext not in NOTEBOOK_EXTENSIONS + ['.auto']:
+    if ext not in _LEGITIMATE_EXTENSIONS:
         raise JupytextFormatError("Extension '{}' is not a notebook extension. Please use one of '{}'.".format(
             ext, "', '".join(NOTEBOOK_EXTENSIONS + ['.auto'])))
 
@@ -18,6 +18,7 @@ _BLANK_RE = re.compile(r"^\s*$")
 _JUPYTER_RE = re.compile(r"^jupyter\s*:\s*$")
 _LEFTSPACE_RE = re.compile(r"^\s")
 _UTF8_HEADER = ' -*- coding: utf-8 -*-'
+_LINE_BREAK_RE = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
 # Change this to False in tests
 INSERT_AND_CHECK_VERSION_NUMBER = True
@@ -125,6 +126,32 @@ def recursive_update(target, update):
     return target
 
 
+def _iter_lines(text):
+    """Iterate over the lines of the text, like text.splitlines() but without splitting the full text"""
+    start = 0
+    for line_break in _LINE_BREAK_RE.finditer(text):
+        yield text[start:line_break.start()]
+        start = line_break.end()
+    if start < len(text):
+        yield text[start:]
+
+
+def markdown_header_lines(text):
+    """Return the first lines of a Markdown document, up to the end of its YAML header"""
+    lines = []
+    in_header = False
+    for line in _iter_lines(text):
+        lines.append(line)
+        if _HEADER_RE.match(line):
+            if in_header:
+                break
+            in_header = True
+        elif not in_header and len(lines) >= 3:
+            # The header starts at most on the third line (after a shebang and an encoding)
+            break
+    return lines
+
+
 def header_to_metadata_and_cell(lines, header_prefix, ext=None):
     """
     Return the metadata, a boolean to indicate if a jupyter section was found,
@@ -5,6 +5,7 @@ import jupytext
 from jupytext.formats import guess_format, divine_format, read_format_from_metadata, rearrange_jupytext_metadata
 from jupytext.formats import long_form_multiple_formats, short_form_multiple_formats, update_jupytext_formats_metadata
 from jupytext.formats import get_format_implementation, validate_one_format, JupytextFormatError
+from jupytext.formats import long_form_one_format
 from .utils import list_notebooks, requires_myst, requires_pandoc
 
 
@@ -84,6 +85,20 @@ def test_script_with_percent_cell_and_magic_is_hydrogen(script="""#%%
     assert guess_format(script, '.py')[0] == 'hydrogen'
 
 
+def test_script_with_percent_cell_and_magic_then_other_markers_is_hydrogen(script="""# %%
+%matplotlib inline
+
+# {{{
+a = 1
+# }}}
+
+###############################################################################
+# A Sphinx-gallery separator
+###############################################################################
+"""):
+    assert guess_format(script, '.py')[0] == 'hydrogen'
+
+
 def test_script_with_percent_cell_and_kernelspec(script="""# ---
 # jupyter:
 #   kernelspec:
@@ -125,6 +140,10 @@ def test_update_jupytext_formats_metadata():
     update_jupytext_formats_metadata(nb.metadata, 'py:light')
     assert nb.metadata['jupytext']['formats'] == 'ipynb,py:light'
 
+    nb = new_notebook(metadata={'jupytext': {'formats': 'ipynb,md'}})
+    update_jupytext_formats_metadata(nb.metadata, 'py:light')
+    assert nb.metadata['jupytext']['formats'] == 'ipynb,md'
+
 
 def test_decompress_formats():
     assert long_form_multiple_formats('ipynb') == [{'extension': '.ipynb'}]
@@ -137,6 +156,20 @@ def test_decompress_formats():
         {'extension': '.py', 'suffix': '.pct', 'format_name': 'percent'}]
 
 
+def test_long_form_one_format_is_not_modified_by_update():
+    with pytest.raises(JupytextFormatError):
+        long_form_one_format('py:percent', update={'x': 1})
+    assert long_form_one_format('py:percent', update={'comment_magics': True}) == {
+        'format_name': 'percent', 'extension': '.py', 'comment_magics': True}
+    assert long_form_one_format('py:percent') == {'format_name': 'percent', 'extension': '.py'}
+
+
+def test_long_form_one_format_bare_warns_every_time():
+    for _ in range(2):
+        with pytest.warns(DeprecationWarning, match='nomarker'):
+            assert long_form_one_format('py:bare') == {'format_name': 'nomarker', 'extension': '.py'}
+
+
 def test_compress_formats():
     assert short_form_multiple_formats([{'extension': '.ipynb'}]) == 'ipynb'
     assert short_form_multiple_formats([{'extension': '.ipynb'}, {'extension': '.md'}]) == 'ipynb,md'
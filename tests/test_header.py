@@ -1,7 +1,9 @@
+import pytest
 from nbformat.v4.nbbase import new_notebook, new_raw_cell, new_markdown_cell
 from jupytext.compare import compare
 import jupytext
 from jupytext.header import uncomment_line, header_to_metadata_and_cell, metadata_and_cell_to_header
+from jupytext.header import _iter_lines, markdown_header_lines
 from jupytext.formats import get_format_implementation
 
 
@@ -67,6 +69,39 @@ title: Sample header
     assert pos == len(lines)
 
 
+@pytest.mark.parametrize('text', ['', '\n', 'a', 'a\nb\n', 'a\r\nb', 'a\rb', 'a\r\n\r\nb',
+                                  'a\x0cb', 'a\u2028b', 'a\n\n'])
+def test_iter_lines_is_splitlines(text):
+    assert list(_iter_lines(text)) == text.splitlines()
+
+
+def test_markdown_header_lines_stops_after_three_lines_when_there_is_no_header(text="""# A title
+
+Some text
+with no header
+
+---
+"""):
+    assert markdown_header_lines(text) == ['# A title', '', 'Some text']
+
+
+def test_markdown_header_lines_after_shebang_and_encoding(text="""#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+---
+jupyter:
+  jupytext:
+    formats: ipynb,md
+---
+
+Some text
+"""):
+    lines = markdown_header_lines(text)
+    assert lines == text.splitlines()[:7]
+    metadata, _, _, _ = header_to_metadata_and_cell(lines, '', '.md')
+    assert metadata['jupytext']['formats'] == 'ipynb,md'
+    assert metadata['jupytext']['executable'] == '/usr/bin/env python'
+
+
 def test_metadata_and_cell_to_header(no_jupytext_version_number):
     metadata = {'jupytext': {'mainlanguage': 'python'}}
     nb = new_notebook(
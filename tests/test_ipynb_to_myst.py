@@ -116,7 +116,8 @@ def test_matches_mystnb():
 
 
 def test_not_installed():
-    with mock.patch("jupytext.formats.JUPYTEXT_FORMATS", return_value=[]):
+    with mock.patch.dict("jupytext.formats._FORMATS_BY_EXT", clear=True), \
+            mock.patch.dict("jupytext.formats._FORMATS_BY_EXT_NAME", clear=True):
         with pytest.raises(JupytextFormatError):
             get_format_implementation(".myst")
 